@@ -1,18 +1,24 @@
 import os
+import json
+import asyncio
 import logging
+from contextlib import asynccontextmanager
+from functools import lru_cache
 from typing import List, Optional, Dict, Any
 from fastapi import FastAPI, HTTPException, Depends, Request, Body
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from dotenv import load_dotenv
-from pydantic import BaseModel, HttpUrl, Field, validator
-import validators
-from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel, HttpUrl, Field
 
-from models import LineContentRequest, LineContentResponse, ScrapedContent, GeneratedContent
-from scraper import BlogScraper
-from content_generator import ContentGenerator
+from models import (
+    LineContentRequest, LineContentResponse, ScrapedContent, GeneratedContent,
+    LineContentBatchResponse
+)
+from scraper import BlogScraper, get_http_client, close_http_client
+from content_generator import ContentGenerator, BATCH_MAX_ITEMS
 from web_search import WebSearchClient
+from cache import LLMCache
 
 # 環境変数の読み込み
 load_dotenv()
@@ -21,11 +27,24 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    アプリケーションのライフサイクル管理
+    
+    スクレイピング用の共有HTTPクライアントを起動時に生成し、終了時に閉じる
+    """
+    get_http_client()
+    yield
+    await close_http_client()
+
+
 # FastAPI アプリケーションの初期化
 app = FastAPI(
     title="コンテンツ自動生成API",
     description="ブログ記事、Instagram投稿、LINE配信記事を自動生成するAPIサービス",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # CORS設定
@@ -45,7 +64,13 @@ if not openai_api_key:
     logger.warning("OPENAI_API_KEYが設定されていません")
 
 
-# ContentGeneratorの依存関係
+# LINE生成結果のキャッシュ（同一パラメータでの再生成時にスクレイピング・Web検索・OpenAI呼び出しを省略）
+line_content_cache = LLMCache(maxsize=1024, ttl=3600)
+
+
+# ContentGeneratorの依存関係（OpenAIクライアントの接続を再利用するためプロセスで1つだけ生成）
+# 最初のリクエスト時に生成されるため、Gunicornの各ワーカーがそれぞれ自身のクライアントを持つ
+@lru_cache(maxsize=1)
 def get_content_generator():
     return ContentGenerator(api_key=openai_api_key)
 
@@ -60,15 +85,9 @@ async def global_exception_handler(request: Request, exc: Exception):
     )
 
 
-# URLリクエスト用のモデル（より柔軟なバリデーション）
+# URLリクエスト用のモデル
 class UrlRequest(BaseModel):
-    url: str = Field(..., description="スクレイピング対象のURL")
-    
-    @validator('url')
-    def validate_url(cls, v):
-        if not validators.url(v):
-            raise ValueError("有効なURLを入力してください")
-        return v
+    url: HttpUrl = Field(..., description="スクレイピング対象のURL")
 
 
 # LINE生成リクエスト統合モデル（複数画像対応）
@@ -78,8 +97,8 @@ class LineGenerateRequest(BaseModel):
     """
     # LineContentRequestのすべてのフィールド
     company_name: str = Field(..., description="会社の正式名称")
-    company_url: str = Field(..., description="企業のサイトトップURL")
-    blog_url: str = Field(..., description="LINE記事用に書き直したい元のブログ記事のURL")
+    company_url: HttpUrl = Field(..., description="企業のサイトトップURL")
+    blog_url: HttpUrl = Field(..., description="LINE記事用に書き直したい元のブログ記事のURL")
     redirect_text: str = Field(
         "詳しく知りたい方は、下のリンクor画像をタップ👇✨", 
         description="元のブログ記事のURLへの誘導文言"
@@ -102,18 +121,33 @@ class LineGenerateRequest(BaseModel):
     # 追加フィールド
     selected_images: List[str] = Field(default_factory=list, description="選択された画像URLのリスト")
     use_web_search: bool = Field(True, description="Web検索を使用するかどうか")
-    
-    @validator('blog_url')
-    def validate_blog_url(cls, v):
-        if not validators.url(v):
-            raise ValueError("有効なブログURLを入力してください")
-        return v
-    
-    @validator('company_url')
-    def validate_company_url(cls, v):
-        if not validators.url(v):
-            raise ValueError("有効な企業URLを入力してください")
-        return v
+    regenerate: bool = Field(False, description="キャッシュを使用せずに再生成するかどうか")
+
+
+def to_line_content_request(request: LineGenerateRequest) -> LineContentRequest:
+    """
+    統合リクエストモデルからコンテンツ生成用のLineContentRequestを作成する
+    """
+    return LineContentRequest(
+        company_name=request.company_name,
+        company_url=request.company_url,
+        blog_url=request.blog_url,
+        redirect_text=request.redirect_text,
+        bracket_type=request.bracket_type,
+        honorific=request.honorific,
+        child_honorific=request.child_honorific,
+        fixed_format=request.fixed_format,
+        add_emotional_intro=request.add_emotional_intro,
+        writing_style=request.writing_style,
+        line_break_style=request.line_break_style,
+        content_length=request.content_length,
+        date_format=request.date_format,
+        bullet_point=request.bullet_point,
+        emoji_types=request.emoji_types,
+        emoji_count=request.emoji_count,
+        greeting_text=request.greeting_text,
+        reference_template=request.reference_template
+    )
 
 
 @app.get("/")
@@ -138,10 +172,11 @@ async def scrape_blog(request: UrlRequest):
     ブログ記事URLをスクレイピングし、コンテンツと画像を取得する
     """
     try:
-        url = request.url
+        url = str(request.url)
         logger.info(f"スクレイピング開始: {url}")
         scraper = BlogScraper(url)
-        content = scraper.scrape()
+        # 画像選択用に記事内のすべての画像が必要なため、ダウンロードを途中で打ち切らない
+        content = await scraper.scrape(early_exit=False)
         logger.info(f"スクレイピング完了: {url} - タイトル: {content.title[:30]}...")
         return content
     except ValueError as e:
@@ -165,17 +200,22 @@ async def generate_line_content(
     フロントエンドから送信される形式に合わせて、単一のリクエストモデルでパラメータを受け取る
     """
     try:
-        # 受信したリクエストの内容をログに出力（デバッグ用）
-        request_dict = jsonable_encoder(request)
         selected_images = request.selected_images
         use_web_search = request.use_web_search
         
         logger.info(f"LINE記事生成開始: URL={request.blog_url}, WebSearch={use_web_search}, 画像数={len(selected_images)}")
         
+        # 同一パラメータでの生成結果がキャッシュにあればそれを返す（再生成の場合は使用しない）
+        cache_key = LLMCache.make_key(request.dict(exclude={"regenerate"}))
+        if not request.regenerate:
+            cached_response = line_content_cache.get(cache_key)
+            if cached_response is not None:
+                return cached_response
+        
         # 元のブログ記事をスクレイピング
         try:
             scraper = BlogScraper(str(request.blog_url))
-            scraped_content = scraper.scrape()
+            scraped_content = await scraper.scrape()
         except Exception as e:
             logger.error(f"スクレイピングエラー: {str(e)}")
             raise HTTPException(status_code=500, detail=f"記事のスクレイピングに失敗しました: {str(e)}")
@@ -183,29 +223,10 @@ async def generate_line_content(
         logger.info(f"スクレイピング完了: {len(scraped_content.content)} 文字, {len(scraped_content.images)} 画像")
         
         # LineContentRequestのインスタンスを作成
-        line_request = LineContentRequest(
-            company_name=request.company_name,
-            company_url=request.company_url,
-            blog_url=request.blog_url,
-            redirect_text=request.redirect_text,
-            bracket_type=request.bracket_type,
-            honorific=request.honorific,
-            child_honorific=request.child_honorific,
-            fixed_format=request.fixed_format,
-            add_emotional_intro=request.add_emotional_intro,
-            writing_style=request.writing_style,
-            line_break_style=request.line_break_style,
-            content_length=request.content_length,
-            date_format=request.date_format,
-            bullet_point=request.bullet_point,
-            emoji_types=request.emoji_types,
-            emoji_count=request.emoji_count,
-            greeting_text=request.greeting_text,
-            reference_template=request.reference_template
-        )
+        line_request = to_line_content_request(request)
         
         # LINE配信コンテンツの生成（複数画像と Web検索機能を利用）
-        generated_options = content_generator.generate_line_content(
+        generated_options = await content_generator.generate_line_content(
             request=line_request,
             scraped_content=scraped_content,
             selected_images=selected_images,
@@ -214,10 +235,13 @@ async def generate_line_content(
         
         logger.info(f"生成完了: {len(generated_options)} 個のコンテンツオプション")
         
-        return LineContentResponse(
+        response = LineContentResponse(
             scraped_content=scraped_content,
             generated_options=generated_options
         )
+        line_content_cache.set(cache_key, response)
+        
+        return response
     
     except ValueError as e:
         # バリデーションエラー
@@ -229,6 +253,112 @@ async def generate_line_content(
         raise HTTPException(status_code=500, detail=f"LINE配信コンテンツの生成に失敗しました: {str(e)}")
 
 
+@app.post("/api/generate-line-content-stream")
+async def generate_line_content_stream(
+    request: LineGenerateRequest = Body(...),
+    content_generator: ContentGenerator = Depends(get_content_generator)
+):
+    """
+    LINE配信用のコンテンツをストリーミングで生成する
+    
+    NDJSON形式で、最初の行にスクレイピング結果、以降の行に
+    バリエーション番号付きの生成イベントを返す
+    """
+    logger.info(f"LINE記事ストリーミング生成開始: URL={request.blog_url}, WebSearch={request.use_web_search}, 画像数={len(request.selected_images)}")
+    
+    # ストリーミング開始前にスクレイピングを済ませ、失敗時は通常のエラーレスポンスを返す
+    try:
+        scraper = BlogScraper(str(request.blog_url))
+        scraped_content = await scraper.scrape()
+        line_request = to_line_content_request(request)
+    except ValueError as e:
+        logger.error(f"バリデーションエラー: {str(e)}")
+        raise HTTPException(status_code=422, detail=str(e))
+    except Exception as e:
+        logger.error(f"スクレイピングエラー: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"記事のスクレイピングに失敗しました: {str(e)}")
+    
+    async def event_stream():
+        yield json.dumps({"scraped_content": scraped_content.dict()}, ensure_ascii=False) + "\n"
+        
+        async for event in content_generator.stream_line_content(
+            request=line_request,
+            scraped_content=scraped_content,
+            selected_images=request.selected_images,
+            use_web_search=request.use_web_search
+        ):
+            yield json.dumps(event, ensure_ascii=False) + "\n"
+    
+    return StreamingResponse(event_stream(), media_type="application/x-ndjson")
+
+
+@app.post("/api/generate-line-content-batch", response_model=LineContentBatchResponse)
+async def generate_line_content_batch(
+    requests: List[LineGenerateRequest] = Body(...),
+    content_generator: ContentGenerator = Depends(get_content_generator)
+):
+    """
+    複数のブログ記事のLINE配信コンテンツ生成をOpenAIのBatch APIに登録する
+    
+    即時性が不要な一括生成向け。結果は GET /api/generate-line-content-batch/{batch_id} で取得する
+    """
+    if not requests:
+        raise HTTPException(status_code=422, detail="リクエストが空です")
+    
+    # スクレイピングを始める前に記事数の上限を確認する
+    if len(requests) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=422, detail=f"バッチに含められる記事は {BATCH_MAX_ITEMS} 件までです")
+    
+    try:
+        logger.info(f"LINE記事バッチ生成開始: {len(requests)} 記事")
+        
+        # 元のブログ記事を並列にスクレイピング（失敗した記事は記事ごとのエラーとして返す）
+        scraped_contents = await asyncio.gather(
+            *[BlogScraper(str(request.blog_url)).scrape() for request in requests],
+            return_exceptions=True
+        )
+        
+        inputs = []
+        for request, scraped_content in zip(requests, scraped_contents):
+            if isinstance(scraped_content, Exception):
+                logger.error(f"スクレイピングエラー: {request.blog_url} - {str(scraped_content)}")
+                inputs.append((to_line_content_request(request), None, request.selected_images, request.use_web_search, str(scraped_content)))
+            else:
+                inputs.append((to_line_content_request(request), scraped_content, request.selected_images, request.use_web_search, None))
+        
+        return await content_generator.submit_line_content_batch(inputs)
+    
+    except HTTPException:
+        raise
+        
+    except ValueError as e:
+        # バリデーションエラー
+        logger.error(f"バリデーションエラー: {str(e)}")
+        raise HTTPException(status_code=422, detail=str(e))
+        
+    except Exception as e:
+        logger.error(f"バッチ登録エラー: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"LINE配信コンテンツのバッチ登録に失敗しました: {str(e)}")
+
+
+@app.get("/api/generate-line-content-batch/{batch_id}", response_model=LineContentBatchResponse)
+async def get_line_content_batch(
+    batch_id: str,
+    content_generator: ContentGenerator = Depends(get_content_generator)
+):
+    """
+    バッチ生成の状態を取得する（完了していれば生成結果も返す）
+    """
+    try:
+        return await content_generator.retrieve_line_content_batch(batch_id)
+    except Exception as e:
+        logger.error(f"バッチ取得エラー: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"LINE配信コンテンツのバッチ取得に失敗しました: {str(e)}")
+
+
 if __name__ == "__main__":
     import uvicorn
+    # 開発用のシングルプロセス起動（本番は gunicorn app:app -c gunicorn.conf.py でマルチワーカー起動）
+    # loop / http は既定の "auto" のまま、uvloop と httptools がインストールされていれば
+    # (uvicorn[standard]) 自動で使用される。未インストールの環境（Windowsなど）では標準実装で起動する
     uvicorn.run("app:app", host="0.0.0.0", port=8001, reload=True)
\ No newline at end of file
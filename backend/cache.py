@@ -0,0 +1,142 @@
+import json
+import time
+import hashlib
+import logging
+from typing import Any, Callable, Dict, List, Optional, Sequence
+import numpy as np
+from cachetools import TTLCache
+
+logger = logging.getLogger(__name__)
+
+
+class LLMCache:
+    """LLMの生成結果をリクエスト内容のハッシュで保持するインメモリキャッシュ"""
+
+    def __init__(self, maxsize: int = 1024, ttl: int = 3600):
+        """
+        LLMCache クラスの初期化
+
+        Args:
+            maxsize: 保持する最大エントリ数
+            ttl: エントリの有効期間（秒）
+        """
+        self._cache: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(params: Dict[str, Any]) -> str:
+        """
+        リクエストパラメータから安定したキャッシュキーを生成する
+
+        Args:
+            params: キャッシュキーの元となるパラメータ
+
+        Returns:
+            SHA-256のハッシュ文字列
+        """
+        payload = json.dumps(params, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Any]:
+        """キャッシュから値を取得する（存在しない場合はNone）"""
+        value = self._cache.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        logger.info(f"LLMキャッシュ: {'ヒット' if value is not None else 'ミス'} (hits={self.hits}, misses={self.misses})")
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        """キャッシュに値を保存する"""
+        self._cache[key] = value
+
+
+class SemanticCache:
+    """埋め込みベクトルのコサイン類似度で近いクエリの結果を返すインメモリキャッシュ"""
+
+    def __init__(self, threshold: float = 0.92, maxsize: int = 512, ttl: int = 3600):
+        """
+        SemanticCache クラスの初期化
+
+        Args:
+            threshold: キャッシュヒットとみなすコサイン類似度の下限
+            maxsize: 保持する最大エントリ数（超えた場合は古いものから削除）
+            ttl: エントリの有効期間（秒）
+        """
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._matrix: Optional[np.ndarray] = None
+        self._values: List[Any] = []
+        self._expires_at: List[float] = []
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _normalize(embedding: Sequence[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def get(
+        self,
+        embedding: Sequence[float],
+        guard: Optional[Callable[[Any], bool]] = None
+    ) -> Optional[Any]:
+        """
+        類似度がしきい値を超えるエントリのうち、最も近いものの値を取得する
+
+        Args:
+            embedding: クエリの埋め込みベクトル
+            guard: 値を返してよいか判定する関数（Falseの場合は次に近いエントリを調べる）
+
+        Returns:
+            キャッシュされた値（該当なしの場合はNone）
+        """
+        self._evict_expired()
+        if self._matrix is None:
+            self.misses += 1
+            return None
+
+        # 保存済みベクトルは正規化済みのため、行列積1回でコサイン類似度を計算できる
+        scores = self._matrix @ self._normalize(embedding)
+        candidates = np.flatnonzero(scores > self.threshold)
+        for index in candidates[np.argsort(-scores[candidates])]:
+            value = self._values[index]
+            if guard is None or guard(value):
+                self.hits += 1
+                logger.info(f"セマンティックキャッシュ: ヒット (類似度={scores[index]:.3f}, hits={self.hits}, misses={self.misses})")
+                return value
+
+        self.misses += 1
+        return None
+
+    def set(self, embedding: Sequence[float], value: Any) -> None:
+        """埋め込みベクトルと値を保存する"""
+        vector = self._normalize(embedding)[np.newaxis, :]
+        if self._matrix is None:
+            self._matrix = vector
+        else:
+            self._matrix = np.vstack([self._matrix, vector])
+        self._values.append(value)
+        self._expires_at.append(time.monotonic() + self.ttl)
+
+        if len(self._values) > self.maxsize:
+            self._remove_oldest(len(self._values) - self.maxsize)
+
+    def _evict_expired(self) -> None:
+        """有効期限切れのエントリを削除する（登録順に期限が来るため先頭から削除）"""
+        now = time.monotonic()
+        expired = 0
+        while expired < len(self._expires_at) and self._expires_at[expired] <= now:
+            expired += 1
+        if expired:
+            self._remove_oldest(expired)
+
+    def _remove_oldest(self, count: int) -> None:
+        """古いものから指定した数のエントリを削除する"""
+        del self._values[:count]
+        del self._expires_at[:count]
+        self._matrix = self._matrix[count:] if self._values else None
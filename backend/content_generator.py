@@ -1,12 +1,104 @@
 import os
+import json
+import asyncio
 import logging
-from typing import List, Optional, Dict, Any
+from collections import defaultdict
+from typing import List, Optional, Dict, Any, Tuple, AsyncIterator
 import openai
-from models import LineContentRequest, ScrapedContent, GeneratedContent
+import tiktoken
+from models import (
+    LineContentRequest, ScrapedContent, GeneratedContent,
+    LineContentBatchItem, LineContentBatchResponse
+)
 from web_search import WebSearchClient
 
 logger = logging.getLogger(__name__)
 
+# 1リクエストで生成するバリエーション数
+VARIATION_COUNT = 3
+
+# 元記事の本文に割り当てるトークン数
+CONTENT_TOKEN_LIMIT = 900
+
+# gpt-4o のコンテキスト長と、1バリエーションあたりの最大生成トークン数
+MODEL_CONTEXT_TOKENS = 128000
+MAX_COMPLETION_TOKENS = 800
+
+# システムプロンプトのトークン予算（チャット形式のオーバーヘッドとユーザーメッセージ分の余裕を差し引く）
+PROMPT_TOKEN_BUDGET = MODEL_CONTEXT_TOKENS - MAX_COMPLETION_TOKENS - 100
+
+# リクエストに依存しない指示（全リクエストで同一のプレフィックスとなる）
+STATIC_INSTRUCTIONS = """あなたは企業のLINE配信記事のプロの作成者です。元のブログ記事をLINE配信向けに最適化された記事に書き換える必要があります。
+
+# 指示
+1. オリジナルのブログコンテンツの主要なメッセージを保持しながら、LINEのカジュアルな配信向けに最適化してください。
+2. 指定された絵文字を適切な場所に使い、親しみやすさを演出してください。
+3. 記事の最後には必ず元の記事へのリンク誘導文を入れてください。
+4. 顧客目線で、読者の興味を引く内容に仕上げてください。
+5. 文字数は指定された長さにしてください。
+6. 必要に応じて箇条書きを使って見やすくしてください。
+7. Web検索から得た追加情報がある場合は、それも活用して記事の価値を高めてください。ただし、情報源の詳細なURLなどは含めないでください。
+
+最終的な出力は、LINEで配信するテキストのみを含めてください。マークダウン形式は必要ありません。
+"""
+
+# リクエスト固有の情報
+REQUEST_SECTION = """
+# 企業情報
+- 企業名: {company_name}
+- 企業URL: {company_url}
+
+# 元のブログ記事
+タイトル: {title}
+
+コンテンツ:
+{content}
+
+{web_search_section}
+
+# LINE配信記事の要件
+- 記事の長さ: {content_length}
+- 文体: {writing_style}（丁寧/カジュアル）
+- 改行位置: {line_break_style}
+- かっこの種類: {bracket_type}
+- 敬称: {honorific}
+- 子どもの敬称: {child_honorific}
+- 感情を誘発させる文頭: {emotional_intro}
+- 絵文字の種類: {emoji_types}
+- 絵文字の量: {emoji_count}個程度/配信
+- 箇条書き記号: {bullet_point}
+- 日時フォーマット: {date_format}
+- 挨拶文: {greeting_text}
+- 元記事への誘導: {redirect_text}
+- 画像: {images}
+
+{image_instruction}
+
+{template_instruction}
+"""
+
+WEB_SEARCH_SECTION = """# Web検索で収集した追加情報
+
+{summary}
+
+この情報を適切に利用して、記事の内容を充実させてください。ただし、過度に専門的になりすぎず、LINE配信の読みやすさを保ってください。
+"""
+
+TEMPLATE_SECTION = """以下のテンプレートを参考にして、全体的な文調とフォーマットを模倣してください：
+
+{reference_template}
+"""
+
+# バッチ1件に含められる記事数の上限（スクレイピングとWeb検索を登録時に行うため）
+BATCH_MAX_ITEMS = 100
+
+# バッチが終了したとみなす状態（出力ファイル・エラーファイルが確定している）
+BATCH_TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+# バッチ生成の1記事分の入力
+# （リクエスト、スクレイピング結果、選択画像、Web検索の有無、スクレイピング失敗時のエラー）
+BatchInput = Tuple[LineContentRequest, Optional[ScrapedContent], List[str], bool, Optional[str]]
+
 class ContentGenerator:
     """OpenAI APIを使用してLINE配信用のコンテンツを生成するクラス"""
     
@@ -23,10 +115,19 @@ class ContentGenerator:
         
         openai.api_key = self.api_key
         
+        # 非同期クライアントはインスタンスごとに1度だけ生成し、Web検索クライアントとも共有する
+        self.client = openai.AsyncOpenAI(api_key=self.api_key, max_retries=2, timeout=30)
+        
+        # プロンプトのトークン数を計算するためのエンコーダ
+        self.enc = tiktoken.encoding_for_model("gpt-4o")
+        
+        # OpenAIのレート制限を考慮して同時リクエスト数を制限（プロセスごとの上限。Gunicornでは設定ファイルで調整）
+        self._semaphore = asyncio.Semaphore(int(os.environ.get("OPENAI_MAX_CONCURRENCY", 5)))
+        
         # Web検索クライアントの初期化
-        self.web_search_client = WebSearchClient(api_key=self.api_key)
+        self.web_search_client = WebSearchClient(api_key=self.api_key, client=self.client)
     
-    def generate_line_content(
+    async def generate_line_content(
         self, 
         request: LineContentRequest, 
         scraped_content: ScrapedContent,
@@ -46,6 +147,320 @@ class ContentGenerator:
             生成されたコンテンツの選択肢のリスト
         """
         # Web検索を使用して追加情報を取得
+        web_search_info = await self._get_web_search_info(request, scraped_content, use_web_search)
+        
+        # プロンプトを構築
+        prompt = self._build_system_prompt(request, scraped_content, selected_images, web_search_info)
+        
+        # 3つのバリエーションを1回のリクエスト (n=3) で生成
+        try:
+            async with self._semaphore:
+                response = await self.client.chat.completions.create(**self._chat_params(prompt))
+        except Exception as e:
+            logger.error(f"コンテンツ生成中にエラーが発生しました: {str(e)}")
+            raise Exception(f"OpenAI APIでのコンテンツ生成に失敗しました: {str(e)}")
+        
+        variations = []
+        for choice in sorted(response.choices, key=lambda c: c.index):
+            content = choice.message.content
+            
+            # マークダウン形式の整形（複数画像対応）
+            markdown = self._format_as_markdown(content, selected_images, request.blog_url)
+            
+            variations.append(
+                GeneratedContent(
+                    content=content,
+                    markdown=markdown
+                )
+            )
+        
+        return variations
+    
+    async def stream_line_content(
+        self, 
+        request: LineContentRequest, 
+        scraped_content: ScrapedContent,
+        selected_images: List[str] = [],
+        use_web_search: bool = True
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        LINE配信用のコンテンツをストリーミングで生成する
+        
+        3つのバリエーションを1回のリクエスト (n=3) でストリーミングし、到着順にイベントとして返す
+        
+        Args:
+            request: LINE配信記事のリクエストパラメータ
+            scraped_content: スクレイピングされたブログコンテンツ
+            selected_images: 選択された画像URLのリスト
+            use_web_search: Web検索APIを使用するかどうか
+            
+        Yields:
+            バリエーション番号付きのイベント
+            （生成途中のテキスト "delta"、完了時の "content" と "markdown"）、
+            または失敗時の "error" イベント
+        """
+        # Web検索を使用して追加情報を取得
+        web_search_info = await self._get_web_search_info(request, scraped_content, use_web_search)
+        
+        # プロンプトを構築
+        prompt = self._build_system_prompt(request, scraped_content, selected_images, web_search_info)
+        
+        # ストリームの受信は別タスクで行い、受信した差分をキューで受け渡す
+        # （読み手が遅くてもセマフォを占有し続けないよう、yield はセマフォの外で行う）
+        queue: asyncio.Queue = asyncio.Queue()
+        task = asyncio.create_task(self._receive_stream(prompt, queue))
+        
+        # 各チャンクの choice.index でバリエーションを識別する
+        chunks: Dict[int, List[str]] = defaultdict(list)
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    yield {"error": f"OpenAI APIでのコンテンツ生成に失敗しました: {str(item)}"}
+                    return
+                
+                index, delta = item
+                chunks[index].append(delta)
+                yield {"variation": index, "delta": delta}
+        finally:
+            # クライアントが切断した場合などはストリームを中断する
+            task.cancel()
+        
+        for index in sorted(chunks):
+            content = "".join(chunks[index])
+            yield {
+                "variation": index,
+                "content": content,
+                "markdown": self._format_as_markdown(content, selected_images, request.blog_url)
+            }
+    
+    async def _receive_stream(self, prompt: str, queue: asyncio.Queue) -> None:
+        """
+        n=3 のストリーミング生成を受信し、(バリエーション番号, 差分) をキューに送る
+        
+        Args:
+            prompt: システムプロンプト
+            queue: 送信先のキュー（失敗時は例外、終了時は None を送る）
+        """
+        try:
+            async with self._semaphore:
+                stream = await self.client.chat.completions.create(**self._chat_params(prompt), stream=True)
+                # キャンセルされた場合もストリームを閉じて生成を打ち切る
+                async with stream:
+                    async for chunk in stream:
+                        for choice in chunk.choices:
+                            delta = choice.delta.content
+                            if delta:
+                                queue.put_nowait((choice.index, delta))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"コンテンツ生成中にエラーが発生しました: {str(e)}")
+            queue.put_nowait(e)
+        finally:
+            queue.put_nowait(None)
+    
+    async def submit_line_content_batch(self, inputs: List[BatchInput]) -> LineContentBatchResponse:
+        """
+        複数記事分のLINE配信コンテンツ生成をOpenAIのBatch APIに登録する
+        
+        即時性が不要な一括生成向け。結果は retrieve_line_content_batch で取得する。
+        スクレイピングに失敗した記事は登録せず、エラーとして結果に含める
+        
+        Args:
+            inputs: 記事ごとのリクエスト、スクレイピング結果、選択画像、Web検索の有無、スクレイピングのエラー
+            
+        Returns:
+            登録したバッチのIDと状態（登録できなかった記事はエラーとして results に含める）
+            
+        Raises:
+            ValueError: 記事数が上限を超える場合、または登録できる記事がない場合
+        """
+        if len(inputs) > BATCH_MAX_ITEMS:
+            raise ValueError(f"バッチに含められる記事は {BATCH_MAX_ITEMS} 件までです")
+        
+        # マークダウン整形用の情報とスクレイピングのエラーは記事ごとにまとめてファイルに保存し、
+        # バッチのメタデータにはそのファイルIDだけを持たせる（どのプロセスからも取得できるようにする）
+        batch_context = [
+            {"blog_url": str(request.blog_url), "selected_images": selected_images, "error": error}
+            for request, _, selected_images, _, error in inputs
+        ]
+        
+        targets = [
+            (item_index, request, scraped_content, selected_images, use_web_search)
+            for item_index, (request, scraped_content, selected_images, use_web_search, _) in enumerate(inputs)
+            if scraped_content is not None
+        ]
+        if not targets:
+            raise ValueError("登録できる記事がありません。すべての記事のスクレイピングに失敗しました")
+        
+        # Web検索もOpenAI APIを呼び出すため、同時実行数をセマフォで制限する
+        async def get_web_search_info(request, scraped_content, use_web_search):
+            async with self._semaphore:
+                return await self._get_web_search_info(request, scraped_content, use_web_search)
+        
+        web_search_infos = await asyncio.gather(*[
+            get_web_search_info(request, scraped_content, use_web_search)
+            for _, request, scraped_content, _, use_web_search in targets
+        ])
+        
+        # 記事ごとに1行のJSONLを構築（バリエーションは n=3 で1リクエストにまとめる）
+        lines = []
+        for (item_index, request, scraped_content, selected_images, _), web_search_info in zip(targets, web_search_infos):
+            prompt = self._build_system_prompt(request, scraped_content, selected_images, web_search_info)
+            lines.append(json.dumps({
+                "custom_id": str(item_index),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": self._chat_params(prompt)
+            }, ensure_ascii=False))
+        
+        try:
+            # 後からダウンロードできるよう、入力ファイルと同じ purpose の JSONL として保存する
+            context_file = await self.client.files.create(
+                file=(
+                    "line_content_batch_context.jsonl",
+                    "\n".join(json.dumps(context, ensure_ascii=False) for context in batch_context).encode("utf-8")
+                ),
+                purpose="batch"
+            )
+            input_file = await self.client.files.create(
+                file=("line_content_batch.jsonl", "\n".join(lines).encode("utf-8")),
+                purpose="batch"
+            )
+            batch = await self.client.batches.create(
+                input_file_id=input_file.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h",
+                metadata={"context_file_id": context_file.id}
+            )
+        except Exception as e:
+            logger.error(f"バッチの登録中にエラーが発生しました: {str(e)}")
+            raise Exception(f"OpenAI Batch APIへの登録に失敗しました: {str(e)}")
+        
+        logger.info(f"バッチを登録しました: {batch.id} ({len(inputs)} 記事, {len(lines)} リクエスト)")
+        
+        return LineContentBatchResponse(
+            batch_id=batch.id,
+            status=batch.status,
+            results=[
+                LineContentBatchItem(blog_url=context["blog_url"], error=context["error"])
+                for context in batch_context
+                if context["error"]
+            ]
+        )
+    
+    async def retrieve_line_content_batch(self, batch_id: str) -> LineContentBatchResponse:
+        """
+        Batch APIに登録したLINE配信コンテンツ生成の状態と結果を取得する
+        
+        Args:
+            batch_id: submit_line_content_batch で登録したバッチのID
+            
+        Returns:
+            バッチの状態と、終了していれば記事ごとの生成結果
+            （期限切れ・キャンセル・失敗の場合も、生成済みの記事の結果は返す）
+        """
+        try:
+            batch = await self.client.batches.retrieve(batch_id)
+        except Exception as e:
+            logger.error(f"バッチの取得中にエラーが発生しました: {str(e)}")
+            raise Exception(f"OpenAI Batch APIからの取得に失敗しました: {str(e)}")
+        
+        if batch.status not in BATCH_TERMINAL_STATUSES:
+            return LineContentBatchResponse(batch_id=batch.id, status=batch.status)
+        
+        # マークダウン整形用の情報は、メタデータに記録したファイルから復元する
+        batch_context = await self._load_batch_context(batch.metadata)
+        
+        # 出力ファイルとエラーファイルの各行を custom_id ごとに振り分ける
+        contents: Dict[int, List[str]] = {}
+        errors: Dict[int, str] = {}
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            file_content = await self.client.files.content(file_id)
+            for line in file_content.text.splitlines():
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                item_index = int(record["custom_id"])
+                response = record.get("response") or {}
+                if record.get("error") or response.get("status_code") != 200:
+                    errors[item_index] = str(record.get("error") or response.get("body"))
+                    continue
+                choices = sorted(response["body"]["choices"], key=lambda c: c["index"])
+                contents[item_index] = [choice["message"]["content"] for choice in choices]
+        
+        results = []
+        for item_index, context in enumerate(batch_context):
+            blog_url = context["blog_url"]
+            selected_images = context["selected_images"]
+            
+            # スクレイピングのエラー、リクエストのエラー、結果なし（期限切れなど）の順に判定する
+            error = context["error"] or errors.get(item_index)
+            if error is None and item_index not in contents:
+                error = f"バッチが {batch.status} のため結果がありません"
+            
+            results.append(
+                LineContentBatchItem(
+                    blog_url=blog_url,
+                    generated_options=[
+                        GeneratedContent(
+                            content=content,
+                            markdown=self._format_as_markdown(content, selected_images, blog_url)
+                        )
+                        for content in contents.get(item_index, [])
+                    ],
+                    error=error
+                )
+            )
+        
+        return LineContentBatchResponse(batch_id=batch.id, status=batch.status, results=results)
+    
+    async def _load_batch_context(self, metadata: Optional[Dict[str, str]]) -> List[Dict[str, Any]]:
+        """
+        バッチのメタデータに記録したファイルから、記事ごとのブログURL・選択画像・エラーを復元する
+        
+        Args:
+            metadata: バッチのメタデータ
+            
+        Returns:
+            記事ごとの {"blog_url", "selected_images", "error"}
+            
+        Raises:
+            Exception: 記事情報のファイルを取得・復元できない場合
+        """
+        context_file_id = (metadata or {}).get("context_file_id")
+        if not context_file_id:
+            raise Exception("バッチのメタデータに記事情報のファイルIDが含まれていません")
+        
+        try:
+            file_content = await self.client.files.content(context_file_id)
+            return [json.loads(line) for line in file_content.text.splitlines() if line.strip()]
+        except Exception as e:
+            logger.error(f"バッチの記事情報の取得中にエラーが発生しました: {str(e)}")
+            raise Exception(f"バッチの記事情報を復元できませんでした: {str(e)}")
+    
+    async def _get_web_search_info(
+        self,
+        request: LineContentRequest,
+        scraped_content: ScrapedContent,
+        use_web_search: bool = True
+    ) -> Dict[str, Any]:
+        """
+        Web検索を使用して記事に関連する追加情報を取得する
+        
+        Args:
+            request: LINE配信記事のリクエストパラメータ
+            scraped_content: スクレイピングされたブログコンテンツ
+            use_web_search: Web検索APIを使用するかどうか
+            
+        Returns:
+            Web検索から取得した追加情報（未使用・失敗時は空の辞書）
+        """
         web_search_info = {}
         if use_web_search:
             try:
@@ -53,7 +468,7 @@ class ContentGenerator:
                 topic = scraped_content.title
                 
                 # Web検索を実行して関連情報を取得
-                web_search_info = self.web_search_client.enhance_content_with_web_search(
+                web_search_info = await self.web_search_client.enhance_content_with_web_search(
                     request=request,
                     topic=topic
                 )
@@ -64,49 +479,35 @@ class ContentGenerator:
                 logger.warning(f"Web検索中にエラーが発生しましたが、プロセスは続行します: {str(e)}")
                 # エラーがあっても処理を続行
         
-        # プロンプトを構築
-        prompt = self._build_prompt(request, scraped_content, selected_images, web_search_info)
-        
-        # 3つのバリエーションを生成
-        variations = []
+        return web_search_info
+    
+    def _chat_params(self, prompt: str) -> Dict[str, Any]:
+        """
+        バリエーションを生成するChat Completionsのパラメータを構築する
         
-        try:
-            client = openai.OpenAI(api_key=self.api_key)
-            
-            for i in range(3):
-                # OpenAI API を呼び出してコンテンツを生成
-                response = client.chat.completions.create(
-                    model="gpt-4o",  # 最新のモデルに変更
-                    messages=[
-                        {"role": "system", "content": prompt},
-                        {"role": "user", "content": f"LINE配信記事のバリエーション{i+1}を生成してください。"}
-                    ],
-                    max_tokens=800,
-                    temperature=0.7 + (i * 0.1),  # バリエーションごとに少し変化をつける
-                    top_p=0.95,
-                    frequency_penalty=0.0,
-                    presence_penalty=0.0
-                )
-                
-                content = response.choices[0].message.content
-                
-                # マークダウン形式の整形（複数画像対応）
-                markdown = self._format_as_markdown(content, selected_images, request.blog_url)
-                
-                variations.append(
-                    GeneratedContent(
-                        content=content,
-                        markdown=markdown
-                    )
-                )
-                
-        except Exception as e:
-            logger.error(f"コンテンツ生成中にエラーが発生しました: {str(e)}")
-            raise Exception(f"OpenAI APIでのコンテンツ生成に失敗しました: {str(e)}")
+        n=3 で複数のバリエーションを1回のリクエストで生成し、プロンプトの送信も1回にする
         
-        return variations
+        Args:
+            prompt: システムプロンプト
+            
+        Returns:
+            Chat Completions APIのリクエストパラメータ
+        """
+        return {
+            "model": "gpt-4o",  # 最新のモデルに変更
+            "messages": [
+                {"role": "system", "content": prompt},
+                {"role": "user", "content": "LINE配信記事を生成してください。"}
+            ],
+            "max_tokens": MAX_COMPLETION_TOKENS,
+            "n": VARIATION_COUNT,
+            "temperature": 0.8,  # サンプリングでバリエーションに変化をつける
+            "top_p": 0.95,
+            "frequency_penalty": 0.0,
+            "presence_penalty": 0.0
+        }
     
-    def _build_prompt(
+    def _build_system_prompt(
         self, 
         request: LineContentRequest, 
         scraped_content: ScrapedContent,
@@ -114,7 +515,10 @@ class ContentGenerator:
         web_search_info: Optional[Dict[str, Any]] = None
     ) -> str:
         """
-        OpenAI APIに送信するプロンプトを構築する
+        OpenAI APIに送信するシステムプロンプトを構築する
+        
+        全バリエーションで共通の内容とし、リクエストに依存しない指示を先頭に置くことで
+        OpenAIのプロンプトキャッシュが効くようにする
         
         Args:
             request: LINE配信記事のリクエストパラメータ
@@ -123,7 +527,7 @@ class ContentGenerator:
             web_search_info: Web検索から取得した追加情報 (任意)
             
         Returns:
-            構築されたプロンプト
+            構築されたシステムプロンプト
         """
         # イメージ指示
         image_instruction = ""
@@ -133,75 +537,82 @@ class ContentGenerator:
             else:
                 image_instruction = f"記事には{len(selected_images)}枚の添付画像があります。画像について言及せず、テキストのみを生成してください。"
         
-        # 参照テンプレートがある場合
-        template_instruction = ""
-        if request.reference_template:
-            template_instruction = f"""
-            以下のテンプレートを参考にして、全体的な文調とフォーマットを模倣してください：
-            
-            {request.reference_template}
-            """
+        # 固定の指示の後にリクエスト固有の情報を続ける
+        fields = dict(
+            company_name=request.company_name,
+            company_url=request.company_url,
+            title=scraped_content.title,
+            content=self._truncate_tokens(scraped_content.content, CONTENT_TOKEN_LIMIT),  # 長すぎる場合は制限
+            web_search_section="",
+            content_length=request.content_length,
+            writing_style=request.writing_style,
+            line_break_style=request.line_break_style,
+            bracket_type=request.bracket_type,
+            honorific=request.honorific,
+            child_honorific=request.child_honorific,
+            emotional_intro="必要" if request.add_emotional_intro else "不要",
+            emoji_types=request.emoji_types,
+            emoji_count=request.emoji_count,
+            bullet_point=request.bullet_point,
+            date_format=request.date_format,
+            greeting_text=request.greeting_text,
+            redirect_text=request.redirect_text,
+            images="あり (" + str(len(selected_images)) + "枚)" if selected_images else "なし",
+            image_instruction=image_instruction,
+            template_instruction=""
+        )
         
-        # Web検索情報がある場合
-        web_search_section = ""
+        summary = ""
         if web_search_info and 'search_results' in web_search_info and 'summary' in web_search_info['search_results']:
-            web_search_section = f"""
-            # Web検索で収集した追加情報
-            
-            {web_search_info['search_results']['summary']}
-            
-            この情報を適切に利用して、記事の内容を充実させてください。ただし、過度に専門的になりすぎず、LINE配信の読みやすさを保ってください。
-            """
-            
-        # プロンプトを構築
-        prompt = f"""
-        あなたは企業のLINE配信記事のプロの作成者です。元のブログ記事をLINE配信向けに最適化された記事に書き換える必要があります。
-        
-        # 企業情報
-        - 企業名: {request.company_name}
-        - 企業URL: {request.company_url}
-        
-        # 元のブログ記事
-        タイトル: {scraped_content.title}
-        
-        コンテンツ:
-        {scraped_content.content[:1500]}  # 長すぎる場合は制限
+            summary = web_search_info['search_results']['summary']
+        reference_template = request.reference_template or ""
         
-        {web_search_section}
+        # Web検索情報がある場合
+        if summary:
+            fields["web_search_section"] = WEB_SEARCH_SECTION.format(summary=summary)
         
-        # LINE配信記事の要件
-        - 記事の長さ: {request.content_length}
-        - 文体: {request.writing_style}（丁寧/カジュアル）
-        - 改行位置: {request.line_break_style}
-        - かっこの種類: {request.bracket_type}
-        - 敬称: {request.honorific}
-        - 子どもの敬称: {request.child_honorific}
-        - 感情を誘発させる文頭: {"必要" if request.add_emotional_intro else "不要"}
-        - 絵文字の種類: {request.emoji_types}
-        - 絵文字の量: {request.emoji_count}個程度/配信
-        - 箇条書き記号: {request.bullet_point}
-        - 日時フォーマット: {request.date_format}
-        - 挨拶文: {request.greeting_text}
-        - 元記事への誘導: {request.redirect_text}
-        - 画像: {"あり (" + str(len(selected_images)) + "枚)" if selected_images else "なし"}
+        # 参照テンプレートがある場合
+        if reference_template:
+            fields["template_instruction"] = TEMPLATE_SECTION.format(reference_template=reference_template)
         
-        {image_instruction}
+        prompt = STATIC_INSTRUCTIONS + REQUEST_SECTION.format(**fields)
         
-        {template_instruction}
+        # モデルのコンテキスト長を超える場合のみ、Web検索情報、参照テンプレートの順に切り詰める
+        overflow = len(self.enc.encode(prompt)) - PROMPT_TOKEN_BUDGET
+        if overflow > 0 and summary:
+            logger.warning(f"プロンプトがトークン予算を {overflow} トークン超えるため、Web検索情報を切り詰めます")
+            summary = self._truncate_tokens(summary, max(len(self.enc.encode(summary)) - overflow, 0))
+            fields["web_search_section"] = WEB_SEARCH_SECTION.format(summary=summary) if summary else ""
+            prompt = STATIC_INSTRUCTIONS + REQUEST_SECTION.format(**fields)
+            overflow = len(self.enc.encode(prompt)) - PROMPT_TOKEN_BUDGET
         
-        # 指示
-        1. オリジナルのブログコンテンツの主要なメッセージを保持しながら、LINEのカジュアルな配信向けに最適化してください。
-        2. 指定された絵文字を適切な場所に使い、親しみやすさを演出してください。
-        3. 記事の最後には必ず元の記事へのリンク誘導文を入れてください。
-        4. 顧客目線で、読者の興味を引く内容に仕上げてください。
-        5. 文字数は指定された長さにしてください。
-        6. 必要に応じて箇条書きを使って見やすくしてください。
-        7. Web検索から得た追加情報がある場合は、それも活用して記事の価値を高めてください。ただし、情報源の詳細なURLなどは含めないでください。
+        if overflow > 0 and reference_template:
+            logger.warning(f"プロンプトがトークン予算を {overflow} トークン超えるため、参照テンプレートを切り詰めます")
+            reference_template = self._truncate_tokens(reference_template, max(len(self.enc.encode(reference_template)) - overflow, 0))
+            fields["template_instruction"] = TEMPLATE_SECTION.format(reference_template=reference_template) if reference_template else ""
+            prompt = STATIC_INSTRUCTIONS + REQUEST_SECTION.format(**fields)
         
-        最終的な出力は、LINEで配信するテキストのみを含めてください。マークダウン形式は必要ありません。
+        return prompt
+    
+    def _truncate_tokens(self, text: str, max_tokens: int) -> str:
         """
+        テキストを指定したトークン数以内に切り詰める
         
-        return prompt
+        Args:
+            text: 対象のテキスト
+            max_tokens: 最大トークン数
+            
+        Returns:
+            切り詰めたテキスト
+        """
+        tokens = self.enc.encode(text)
+        if len(tokens) <= max_tokens:
+            return text
+        return self._decode_tokens(tokens[:max_tokens])
+    
+    def _decode_tokens(self, tokens: List[int]) -> str:
+        """トークン列をテキストに戻す（途中で切れたマルチバイト文字は除く）"""
+        return self.enc.decode(tokens).rstrip("\ufffd")
     
     def _format_as_markdown(
         self, 
@@ -0,0 +1,32 @@
+import multiprocessing
+import os
+
+# Gunicorn の設定（本番用）
+#
+# 起動方法: gunicorn app:app -c gunicorn.conf.py
+#
+# 各ワーカーは独立したプロセスとして起動し、OpenAIクライアントやスクレイピング用の
+# HTTPクライアントはワーカーごとに生成される（preload_app は使用しない）。
+# キャッシュもワーカーごとに保持される点に注意。
+
+bind = os.environ.get("BIND", "0.0.0.0:8001")
+
+# ワーカー数は 2 * CPUコア数 + 1 を目安とする
+workers = int(os.environ.get("WEB_CONCURRENCY", 2 * multiprocessing.cpu_count() + 1))
+
+# UvicornWorker は uvloop / httptools がインストールされていれば自動で使用する
+# worker_connections は eventlet / gevent ワーカー専用のため設定しない
+# （ワーカーあたりの同時接続数を制限する場合は uvicorn の limit_concurrency を使う）
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# OpenAI API の同時リクエスト数は ContentGenerator のセマフォでワーカーごとに制限される
+# （OPENAI_MAX_CONCURRENCY、既定値 5）。全体の同時リクエスト数は ワーカー数 × OPENAI_MAX_CONCURRENCY
+# となるため、OpenAI のレート制限（RPM/TPM）に合わせて WEB_CONCURRENCY か OPENAI_MAX_CONCURRENCY を調整すること。
+#
+# スクレイピング結果のキャッシュもワーカーごとのため、/api/scrape-blog と
+# /api/generate-line-content が別のワーカーに振り分けられた場合はキャッシュが効かず、再度スクレイピングされる。
+
+# OpenAI API の応答待ちを考慮してタイムアウトを長めに設定
+timeout = 120
+graceful_timeout = 30
+keepalive = 5
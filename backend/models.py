@@ -43,4 +43,18 @@ class GeneratedContent(BaseModel):
 class LineContentResponse(BaseModel):
     """LINE配信記事生成のレスポンスモデル"""
     scraped_content: ScrapedContent
-    generated_options: List[GeneratedContent]
\ No newline at end of file
+    generated_options: List[GeneratedContent]
+
+
+class LineContentBatchItem(BaseModel):
+    """バッチ生成における1記事分の結果"""
+    blog_url: Optional[str] = None
+    generated_options: List[GeneratedContent] = Field(default_factory=list)
+    error: Optional[str] = None
+
+
+class LineContentBatchResponse(BaseModel):
+    """LINE配信記事のバッチ生成のレスポンスモデル"""
+    batch_id: str
+    status: str
+    results: List[LineContentBatchItem] = Field(default_factory=list)
\ No newline at end of file
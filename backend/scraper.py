@@ -1,149 +1,269 @@
-import requests
-from bs4 import BeautifulSoup
+import httpx
+import asyncio
+import lxml.html
+from lxml import etree
 import logging
 from urllib.parse import urljoin
+from cachetools import TTLCache
 from models import ScrapedContent
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+}
+
+
+
+def _has_class(name: str) -> str:
+    """class属性に指定したクラス名を含むかどうかのXPath条件"""
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+# 記事コンテンツを含む代表的な要素のノードテスト（優先度順）
+# article, .article-content, .entry-content, .post-content, #content, .content, main, .main
+CONTENT_NODE_TESTS = [
+    "article",
+    f"*[{_has_class('article-content')}]",
+    f"*[{_has_class('entry-content')}]",
+    f"*[{_has_class('post-content')}]",
+    "*[@id='content']",
+    f"*[{_has_class('content')}]",
+    "main",
+    f"*[{_has_class('main')}]",
+]
+
+# XPathはモジュール読み込み時に1度だけコンパイルして再利用する
+# 候補要素を1回の走査で集めるための結合XPathと、優先度判定用の個別XPath
+CONTENT_XPATH = etree.XPath(" | ".join(f"//{test}" for test in CONTENT_NODE_TESTS))
+_CONTENT_PATTERNS = [etree.XPath(f"boolean(self::{test})") for test in CONTENT_NODE_TESTS]
+
+# h1タグ、article-titleクラスを持つ要素、titleタグの順にタイトルを探す
+_TITLE_XPATHS = [
+    etree.XPath("(//h1)[1]"),
+    etree.XPath(f"(//*[{_has_class('article-title')} or {_has_class('entry-title')} or {_has_class('post-title')}])[1]"),
+    etree.XPath("(//title)[1]"),
+]
+
+_UNWANTED_XPATH = etree.XPath(
+    "descendant::script | descendant::style | descendant::nav | descendant::header | descendant::footer"
+)
+_PARAGRAPH_XPATH = etree.XPath("descendant::p | descendant::h2 | descendant::h3")
+_BLOCK_XPATH = etree.XPath("descendant::div | descendant::span | descendant::section")
+_IMG_XPATH = etree.XPath("descendant::img")
+
+# 記事本文がこの数の段落に達したらダウンロードと解析を打ち切る
+MAX_PARAGRAPHS = 50
+
+# スクレイピング結果をURLごとに保持するキャッシュ（画像選択と記事生成で同じURLを2度取得するため）
+_page_cache: TTLCache = TTLCache(maxsize=512, ttl=900)
+
+# プロセス全体で共有するHTTPクライアント（keep-aliveで接続を再利用する）
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """共有のHTTPクライアントを取得する（未生成の場合は生成する）"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            timeout=10,
+            headers=DEFAULT_HEADERS,
+            http2=True,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32)
+        )
+    return _http_client
+
+
+async def close_http_client() -> None:
+    """共有のHTTPクライアントを閉じる"""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+def _feed(parser: etree.HTMLPullParser, chunk: bytes) -> List[Tuple[str, lxml.html.HtmlElement]]:
+    """受信したチャンクをパーサーに渡し、発生したイベントを返す"""
+    parser.feed(chunk)
+    return list(parser.read_events())
+
+
 class BlogScraper:
     """ブログ記事のスクレイピングを行うクラス"""
     
     def __init__(self, url: str):
         self.url = url
-        self.headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
     
-    def scrape(self) -> ScrapedContent:
-        """記事内容と画像URLを取得する"""
+    async def scrape(self, early_exit: bool = True) -> ScrapedContent:
+        """
+        記事内容と画像URLを取得する（キャッシュがあればそれを返す）
+        
+        Args:
+            early_exit: 本文を取得した時点でダウンロードを打ち切るかどうか
+                （打ち切った場合、それ以降の画像は取得されない）
+        """
+        # キャッシュには (スクレイピング結果, ページ全体を読み込んだか) を保存する
+        cached = _page_cache.get(self.url)
+        if cached is not None:
+            scraped_content, complete = cached
+            if complete or early_exit:
+                logger.info(f"スクレイピング結果のキャッシュを使用します: {self.url}")
+                return scraped_content
+        
         try:
-            response = requests.get(self.url, headers=self.headers, timeout=10)
+            root, complete = await self.fetch(early_exit)
+        except httpx.HTTPError as e:
+            logger.error(f"記事の取得に失敗しました: {str(e)}")
+            raise Exception(f"記事のスクレイピングに失敗しました: {str(e)}")
+        
+        # 抽出処理はCPU処理のため、イベントループを塞がないよう別スレッドで実行
+        scraped_content = await asyncio.to_thread(self.parse, root)
+        _page_cache[self.url] = (scraped_content, complete)
+        return scraped_content
+    
+    async def fetch(self, early_exit: bool = True) -> Tuple[lxml.html.HtmlElement, bool]:
+        """
+        記事のHTMLをストリーミングで取得しながら逐次解析する
+        
+        early_exit が有効な場合、記事本文（articleタグ）の終了、または十分な数の段落を
+        読み込んだ時点で残りのダウンロードを打ち切る
+        
+        Returns:
+            解析済みのHTMLと、ページ全体を読み込んだかどうか
+        """
+        client = get_http_client()
+        async with client.stream("GET", self.url) as response:
             response.raise_for_status()
             
-            soup = BeautifulSoup(response.text, 'lxml')
-            
-            # タイトルの取得
-            title = self._extract_title(soup)
-            
-            # メインコンテンツの取得
-            content = self._extract_content(soup)
-            
-            # 画像URLの取得
-            images = self._extract_images(soup)
-            
-            return ScrapedContent(
-                title=title,
-                content=content,
-                images=images
+            parser = etree.HTMLPullParser(
+                events=("end",),
+                tag=("article", "p"),
+                encoding=response.charset_encoding
             )
+            parser.set_element_class_lookup(lxml.html.HtmlElementClassLookup())
             
-        except requests.RequestException as e:
-            logger.error(f"記事の取得に失敗しました: {str(e)}")
-            raise Exception(f"記事のスクレイピングに失敗しました: {str(e)}")
+            paragraph_count = 0
+            complete = True
+            async for chunk in response.aiter_bytes():
+                # HTMLの解析はCPU処理のため、イベントループを塞がないよう別スレッドで実行
+                events = await asyncio.to_thread(_feed, parser, chunk)
+                
+                article_closed = False
+                for _, element in events:
+                    if element.tag == "article":
+                        article_closed = True
+                    else:
+                        paragraph_count += 1
+                
+                if early_exit and (article_closed or paragraph_count >= MAX_PARAGRAPHS):
+                    logger.info(f"必要な本文を取得したためダウンロードを打ち切ります: {self.url}")
+                    complete = False
+                    break
+        
+        try:
+            root = await asyncio.to_thread(parser.close)
+        except etree.XMLSyntaxError:
+            root = None
+        
+        if root is None:
+            # 空のドキュメントの場合
+            root = lxml.html.document_fromstring("<html></html>")
+        
+        return root, complete
     
-    def _extract_title(self, soup: BeautifulSoup) -> str:
-        """ページタイトルを抽出する"""
-        # h1タグを探す
-        h1 = soup.find('h1')
-        if h1 and h1.text.strip():
-            return h1.text.strip()
+    def parse(self, root: lxml.html.HtmlElement) -> ScrapedContent:
+        """解析済みのHTMLから記事内容と画像URLを抽出する"""
+        # タイトルの取得
+        title = self._extract_title(root)
         
-        # article-titleクラスを持つ要素を探す
-        article_title = soup.find(class_=['article-title', 'entry-title', 'post-title'])
-        if article_title and article_title.text.strip():
-            return article_title.text.strip()
+        # 記事コンテンツを含む要素の特定（本文と画像の抽出で共有）
+        content_element = self._find_content_element(root)
         
-        # titleタグから取得
-        title_tag = soup.find('title')
-        if title_tag and title_tag.text.strip():
-            return title_tag.text.strip()
+        # メインコンテンツの取得
+        content = self._extract_content(content_element)
         
-        return "タイトル不明"
+        # 画像URLの取得
+        images = self._extract_images(root, content_element)
+        
+        return ScrapedContent(
+            title=title,
+            content=content,
+            images=images
+        )
     
-    def _extract_content(self, soup: BeautifulSoup) -> str:
-        """記事本文を抽出する"""
-        # 代表的な記事コンテンツを含む要素を探す
-        content_selectors = [
-            'article', '.article-content', '.entry-content', '.post-content',
-            '#content', '.content', 'main', '.main'
-        ]
-        
-        content_element = None
-        for selector in content_selectors:
-            if selector.startswith('.'):
-                content_element = soup.find(class_=selector[1:])
-            elif selector.startswith('#'):
-                content_element = soup.find(id=selector[1:])
-            else:
-                content_element = soup.find(selector)
-                
-            if content_element:
-                break
+    def _extract_title(self, root: lxml.html.HtmlElement) -> str:
+        """ページタイトルを抽出する"""
+        for title_xpath in _TITLE_XPATHS:
+            for element in title_xpath(root):
+                text = element.text_content().strip()
+                if text:
+                    return text
         
-        if not content_element:
-            content_element = soup
+        return "タイトル不明"
+    
+    def _find_content_element(self, root: lxml.html.HtmlElement) -> lxml.html.HtmlElement:
+        """記事コンテンツを含む要素を探す（見つからない場合はページ全体）"""
+        # 候補を1回の走査で集め、ノードテストの優先度順に選ぶ
+        candidates = CONTENT_XPATH(root)
+        for pattern in _CONTENT_PATTERNS:
+            for candidate in candidates:
+                if pattern(candidate):
+                    return candidate
         
-        # 不要なタグを削除
-        for tag in content_element.find_all(['script', 'style', 'nav', 'header', 'footer']):
-            tag.decompose()
+        return root
+    
+    def _extract_content(self, content_element: lxml.html.HtmlElement) -> str:
+        """記事本文を抽出する"""
+        # 不要なタグを削除（後続のテキストは残す）
+        for element in _UNWANTED_XPATH(content_element):
+            element.drop_tree()
         
         # pタグとh2, h3タグからテキストを抽出
-        paragraphs = content_element.find_all(['p', 'h2', 'h3'])
+        paragraphs = _PARAGRAPH_XPATH(content_element)
         
         if not paragraphs:
             # pタグがない場合はdivやspanなどからテキストを取得
-            paragraphs = content_element.find_all(['div', 'span', 'section'])
+            paragraphs = _BLOCK_XPATH(content_element)
         
-        content = "\n".join([p.get_text().strip() for p in paragraphs if p.get_text().strip()])
+        texts = [p.text_content().strip() for p in paragraphs]
+        content = "\n".join([text for text in texts if text])
         
         # コンテンツが空の場合は全テキストを取得
         if not content:
-            content = content_element.get_text().strip()
+            content = content_element.text_content().strip()
         
         return content
     
-    def _extract_images(self, soup: BeautifulSoup) -> List[str]:
+    def _extract_images(self, root: lxml.html.HtmlElement, content_element: lxml.html.HtmlElement) -> List[str]:
         """記事内の画像URLを抽出する"""
-        images = []
-        
-        # 記事コンテンツ内の画像を探す
-        content_selectors = [
-            'article', '.article-content', '.entry-content', '.post-content',
-            '#content', '.content', 'main', '.main'
-        ]
-        
-        content_element = None
-        for selector in content_selectors:
-            if selector.startswith('.'):
-                content_element = soup.find(class_=selector[1:])
-            elif selector.startswith('#'):
-                content_element = soup.find(id=selector[1:])
-            else:
-                content_element = soup.find(selector)
-                
-            if content_element:
-                break
+        images = self._collect_image_urls(content_element)
         
-        if not content_element:
-            content_element = soup
+        # 画像が見つからない場合はページ全体から探す
+        if not images:
+            images = self._collect_image_urls(root)
         
-        # img タグを探す
-        for img in content_element.find_all('img'):
+        return images
+    
+    def _collect_image_urls(self, element: lxml.html.HtmlElement) -> List[str]:
+        """要素内のimgタグから重複のない画像URLを出現順に集める"""
+        # 同じsrcはurljoinを呼ばずに読み飛ばす
+        seen_srcs = set()
+        seen_urls = set()
+        images = []
+        for img in _IMG_XPATH(element):
             src = img.get('src') or img.get('data-src')
-            if src:
-                # 相対URLを絶対URLに変換
-                full_url = urljoin(self.url, src)
-                images.append(full_url)
+            if not src or src in seen_srcs:
+                continue
+            seen_srcs.add(src)
+            
+            # 相対URLを絶対URLに変換
+            full_url = urljoin(self.url, src)
+            if full_url in seen_urls:
+                continue
+            seen_urls.add(full_url)
+            images.append(full_url)
         
-        # 画像が見つからない場合はページ全体から探す
-        if not images:
-            for img in soup.find_all('img'):
-                src = img.get('src') or img.get('data-src')
-                if src:
-                    full_url = urljoin(self.url, src)
-                    images.append(full_url)
-        
-        # 重複を排除して返す
-        return list(dict.fromkeys(images))
\ No newline at end of file
+        return images
\ No newline at end of file
@@ -1,28 +1,62 @@
 import os
+import re
 import logging
-from typing import List, Optional, Dict, Any
+import unicodedata
+from typing import List, Optional, Dict, Any, Tuple
 import openai
+from cachetools import LRUCache
 from models import LineContentRequest
+from cache import SemanticCache
 
 logger = logging.getLogger(__name__)
 
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+# 類似したトピック（例: 「見学会」と「内覧会」）の検索結果を再利用するためのキャッシュ
+# 他社の検索結果を流用しないよう、企業名ごとに別のキャッシュを持つ
+_search_caches: LRUCache = LRUCache(maxsize=256)
+
+
+def get_search_cache(company_name: str) -> SemanticCache:
+    """企業名に対応する検索結果のキャッシュを取得する（未生成の場合は生成する）"""
+    search_cache = _search_caches.get(company_name)
+    if search_cache is None:
+        search_cache = SemanticCache(threshold=0.92, ttl=3600)
+        _search_caches[company_name] = search_cache
+    return search_cache
+
+
+def _extract_numbers(text: str) -> Tuple[str, ...]:
+    """
+    テキストに含まれる数字（日付・回数・価格など）を出現順に抽出する
+    
+    「5月の見学会」と「6月の見学会」のように埋め込みが近くても内容の異なるトピックを
+    区別するために使う（全角数字は半角に正規化する）
+    """
+    return tuple(re.findall(r"\d+", unicodedata.normalize("NFKC", text)))
+
+
 class WebSearchClient:
     """OpenAIのWebSearch APIを使用してウェブ検索を行うクラス"""
     
-    def __init__(self, api_key: Optional[str] = None):
+    def __init__(self, api_key: Optional[str] = None, client: Optional[openai.AsyncOpenAI] = None):
         """
         WebSearchClient クラスの初期化
         
         Args:
             api_key: OpenAI API キー。None の場合は環境変数から取得
+            client: 共有するOpenAIクライアント。None の場合は新たに生成
         """
         self.api_key = api_key or os.environ.get("OPENAI_API_KEY")
         if not self.api_key:
             raise ValueError("OpenAI API キーが設定されていません")
         
         openai.api_key = self.api_key
+        
+        # 非同期クライアントはインスタンスごとに1度だけ生成する
+        self.client = client or openai.AsyncOpenAI(api_key=self.api_key, max_retries=2, timeout=30)
     
-    def search_related_info(self, query: str, country: str = "JP") -> Dict[str, Any]:
+    async def search_related_info(self, query: str, country: str = "JP") -> Dict[str, Any]:
         """
         指定したクエリに関連する情報をWebSearch APIで検索する
         
@@ -34,10 +68,8 @@ class WebSearchClient:
             検索結果の情報
         """
         try:
-            client = openai.OpenAI(api_key=self.api_key)
-            
             # Responses APIを使用してWeb検索を実行
-            response = client.responses.create(
+            response = await self.client.responses.create(
                 model="gpt-4o",
                 tools=[{
                     "type": "web_search_preview",
@@ -81,7 +113,24 @@ class WebSearchClient:
             logger.error(f"Web検索中にエラーが発生しました: {str(e)}")
             return {"error": str(e), "summary": "", "citations": []}
     
-    def enhance_content_with_web_search(
+    async def _embed(self, text: str) -> Optional[List[float]]:
+        """
+        テキストの埋め込みベクトルを取得する
+        
+        Args:
+            text: 埋め込み対象のテキスト
+            
+        Returns:
+            埋め込みベクトル（取得に失敗した場合はNone）
+        """
+        try:
+            response = await self.client.embeddings.create(model=EMBEDDING_MODEL, input=text)
+            return response.data[0].embedding
+        except Exception as e:
+            logger.warning(f"埋め込みの取得に失敗したため、キャッシュを使用せずに検索します: {str(e)}")
+            return None
+    
+    async def enhance_content_with_web_search(
         self, 
         request: LineContentRequest, 
         topic: str
@@ -96,11 +145,27 @@ class WebSearchClient:
         Returns:
             検索結果を含めた強化情報
         """
+        # 同じ企業の類似トピックの検索結果がキャッシュにあればそれを使う
+        # （日付や回数などの数字が異なるトピックの結果は使わない）
+        search_cache = get_search_cache(request.company_name)
+        numbers = _extract_numbers(topic)
+        embedding = await self._embed(topic)
+        if embedding is not None:
+            cached = search_cache.get(embedding, guard=lambda entry: entry["numbers"] == numbers)
+            if cached is not None:
+                return {
+                    "topic": topic,
+                    "search_results": cached["search_results"]
+                }
+        
         # コンテンツ関連の検索クエリを構築
         search_query = f"{request.company_name} {topic}"
         
         # Web検索を実行
-        search_results = self.search_related_info(search_query)
+        search_results = await self.search_related_info(search_query)
+        
+        if embedding is not None and search_results.get("summary") and not search_results.get("error"):
+            search_cache.set(embedding, {"numbers": numbers, "search_results": search_results})
         
         return {
             "topic": topic,
@@ -63,18 +63,21 @@ export async function scrapeBlogContent(url: string): Promise<ScrapedContent> {
  * @param request LINE配信記事の生成リクエスト
  * @param selectedImages 選択された画像URL配列
  * @param useWebSearch Web検索を使用するかどうか
+ * @param regenerate キャッシュを使用せずに再生成するかどうか
  */
 export async function generateLineContent(
   request: LineContentRequest,
   selectedImages: string[] = [],
-  useWebSearch: boolean = true
+  useWebSearch: boolean = true,
+  regenerate: boolean = false
 ): Promise<LineContentResponse> {
   try {
     // リクエストデータの作成
     const requestData = {
       ...request,
       selected_images: selectedImages,
-      use_web_search: useWebSearch
+      use_web_search: useWebSearch,
+      regenerate
     };
     
     // リクエストをデバッグ出力
@@ -151,10 +151,12 @@ export default function Home() {
 
     try {
       // LINE配信記事を生成（Web検索機能と複数画像を設定に応じて使用）
+      // 生成済みの候補から戻ってきた場合は、同じ結果が返らないよう再生成する
       const response = await generateLineContent(
         formData, 
         state.selectedImages,
-        state.useWebSearch
+        state.useWebSearch,
+        state.generatedOptions.length > 0
       );
       
       setState({